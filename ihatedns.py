@@ -1,8 +1,12 @@
-from typing import Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, TypeVar, Union, cast
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import logging
+import struct
+import time
 import dns
 import dns.message
+import dns.name
 import dns.flags
 import dns.opcode
 import dns.query
@@ -12,108 +16,459 @@ import dns.rcode
 import dns.resolver
 import dns.rdataclass
 import dns.rdatatype
+import dns.ttl
 import dns.exception
+import dns.edns
 import dns.ipv4
 import asyncio
+import socket
 import sqlite3
 from aiohttp import web
 
-RDATA_SEP = "," # if you want to store TXT records with commas in, you probably want to change this
+RDATA_SEP = "," # separates rdatas in PUT urls. If you want to put TXT records with commas in, you probably want to change this
 DEFAULT_TTL = 60
+WIRE_CACHE_SIZE = 4096 # max number of cached UDP responses
+NEGATIVE_CACHE_SIZE = 4096 # max number of cached lookup misses
+CACHE_TTL = 10 # seconds. Also the longest that changes made to the db by anything else go unnoticed
+RRSET_CACHE_SIZE = 4096 # max number of cached decoded records
+SCHEMA_VERSION = 4 # bump this whenever the record table changes
+EDNS_PAYLOAD = 1232 # the UDP payload size we advertise in EDNS responses
+UDP_RCVBUF_SIZE = 4 << 20 # room to absorb bursts of queries (on linux, capped by net.core.rmem_max)
 
 logger = logging.getLogger(__name__)
 
-RowType = Tuple[str, int, str, str, str] # name, ttl, rdclass, rdtype, rdatas
+# precompiled, since these get used for every packet
+_U16 = struct.Struct(">H") # rdata lengths, TCP length prefixes
+_HDR = struct.Struct(">HHHHHH") # id, flags, qdcount, ancount, nscount, arcount
+_QTYPE_QCLASS = struct.Struct(">HH")
+_RR_HEAD = struct.Struct(">HHHI") # name pointer, type, class, ttl (RDLENGTH is stored along with the rdata)
+_OPT_HEAD = struct.Struct(">BHHBBHH") # root name, type, payload size, extended rcode, version, flags, rdlength
+_OPTION_HEAD = struct.Struct(">HH") # option code, length
 
-def row_to_rrset(row: RowType, override_name: Optional[str]=None) -> dns.rrset.RRset:
-	name, ttl, rdclass, rdtype, rdatas = row
-	return dns.rrset.from_text(override_name or name, ttl, rdclass, rdtype, *rdatas.split(RDATA_SEP))
+# the OPT RR we put in responses to EDNS queries: version 0, no flags, no options (same as dnspython's)
+_OPT_RR = _OPT_HEAD.pack(0, dns.rdatatype.OPT, EDNS_PAYLOAD, 0, 0, 0, 0)
 
+# sqlite calls can block for a while (e.g. fsync on commit), so they're all made
+# from this thread rather than the event loop. Having just the one thread also
+# keeps access to the shared connection serialised.
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ihatedns-db")
+
+async def run_db(fn: Callable[..., Any], *args: Any) -> Any:
+	return await asyncio.get_running_loop().run_in_executor(db_executor, fn, *args)
+
+RowType = Tuple[str, int, str, str, bytes, bytes] # name, ttl, rdclass, rdtype, wire, name_wire
+LookupKey = Tuple[Union[str, bytes], str, str] # name (text or wire), rdclass, rdtype
+WireCacheKey = Tuple[bytes, int, int, bool] # lowercased wire-format qname, qtype, qclass, whether the query used EDNS
+WireCache = Dict[WireCacheKey, Tuple[float, bytes]] # key -> (expiry, response template)
+
+# each rdata is prefixed with its 2-byte length, i.e. the RDLENGTH and RDATA fields of an RR
+def rdatas_to_wire(rrset: dns.rrset.RRset) -> bytes:
+	wire = b""
+	for rdata in rrset:
+		rdata_wire = rdata.to_wire()
+		wire += _U16.pack(len(rdata_wire)) + rdata_wire
+	return wire
+
+# raises if the rdatas can't be put on the wire, e.g. if a name in them isn't absolute
 def rrset_to_row(rrset: dns.rrset.RRset) -> RowType:
 	return (
 		rrset.name.to_text(),
 		rrset.ttl,
 		dns.rdataclass.to_text(rrset.rdclass),
 		dns.rdatatype.to_text(rrset.rdtype),
-		RDATA_SEP.join(map(str, rrset.to_rdataset().items.keys()))
+		rdatas_to_wire(rrset),
+		cast(bytes, rrset.name.to_wire()) # it only returns None when writing to a file
 	)
 
-def query_db(db: sqlite3.Connection, name: str, rdclass: str, rdtype: str, override_name: Optional[str]=None) -> Optional[dns.rrset.RRset]:
-	row = db.execute(
-		"""
-			SELECT name, ttl, rdclass, rdtype, rdatas
-			FROM record WHERE name=? AND rdclass=? AND rdtype=?
-		""",
-		(name.lower(), rdclass.upper(), rdtype.upper())
-	).fetchone()
+def wire_to_rdatas(rdclass: str, rdtype: str, wire: bytes) -> List[dns.rdata.Rdata]:
+	rdatas = []
+	i = 0
+	while i < len(wire):
+		rdlen, = _U16.unpack_from(wire, i)
+		rdatas.append(dns.rdata.from_wire(rdclass, rdtype, wire, i + 2, rdlen))
+		i += 2 + rdlen
+	return rdatas
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+# All our caches are dicts of key -> (expiry, value), which evict the oldest
+# entry when they're full.
+
+def cache_get(cache: Dict[K, Tuple[float, V]], key: K) -> Optional[V]:
+	entry = cache.get(key)
+	if entry is None or entry[0] <= time.monotonic():
+		return None
+	return entry[1]
+
+def cache_put(cache: Dict[K, Tuple[float, V]], max_size: int, key: K, value: V, ttl: float=CACHE_TTL) -> None:
+	if key in cache:
+		del cache[key] # replacing an (expired) entry doesn't need to evict anything, but it does move it to the back
+	elif len(cache) >= max_size:
+		del cache[next(iter(cache))] # evict the oldest entry
+	cache[key] = (time.monotonic() + ttl, value)
+
+# lookups that recently found nothing, so that floods of queries for nonexistent
+# names don't all hit sqlite. Only touched from db_executor, and cleared by insert_db.
+negative_cache: Dict[LookupKey, Tuple[float, bool]] = {} # the value is always True
+
+_SELECT_SQL = """
+	SELECT ttl, wire
+	FROM record WHERE name=? AND rdclass=? AND rdtype=?
+"""
+
+# returns the raw (ttl, wire) for the record, see lookup_rrset for something friendlier.
+# name must be absolute and lowercase, and rdclass/rdtype uppercase, like in the db.
+def query_db(db: sqlite3.Connection, name: str, rdclass: str, rdtype: str) -> Optional[Tuple[int, bytes]]:
+	key = (name, rdclass, rdtype)
+	if cache_get(negative_cache, key):
+		return None
+	row = db.execute(_SELECT_SQL, key).fetchone()
+	if row is None:
+		cache_put(negative_cache, NEGATIVE_CACHE_SIZE, key, True)
+	return row
+
+# decoded records, keyed by the name as stored in the db (so a wildcard record is
+# only decoded once, not per-name). Misses are left to the negative cache. Only
+# touched from db_executor, and cleared by insert_db.
+rrset_cache: Dict[Tuple[str, str, str], Tuple[float, dns.rrset.RRset]] = {}
+
+# the RRsets are shared between callers, so don't modify them!
+def lookup_rrset(db: sqlite3.Connection, name: str, rdclass: str, rdtype: str) -> Optional[dns.rrset.RRset]:
+	key = (name, rdclass, rdtype)
+	cached = cache_get(rrset_cache, key)
+	if cached is not None:
+		return cached
+	row = query_db(db, name, rdclass, rdtype)
 	if row is None:
 		return None
-	return row_to_rrset(row, override_name=override_name or name)
+	ttl, wire = row
+	rrset = dns.rrset.from_rdata_list(name, ttl, wire_to_rdatas(rdclass, rdtype, wire))
+	cache_put(rrset_cache, RRSET_CACHE_SIZE, key, rrset)
+	return rrset
+
+# written as a join (rather than a row-value IN) so that sqlite looks each key up
+# via the primary key index, instead of scanning the whole table
+_SELECT_MANY_SQL = """
+	SELECT record.name, record.rdclass, record.rdtype, record.ttl, record.wire
+	FROM (VALUES {}) AS k JOIN record
+	ON record.name=k.column1 AND record.rdclass=k.column2 AND record.rdtype=k.column3
+"""
+_SELECT_MANY_CHUNK = 256 # keys per query, keeps us well under sqlite's limit on parameters
+
+# like query_db, but for many keys at once, without the negative cache
+def query_db_many(db: sqlite3.Connection, keys: List[Tuple[str, str, str]]) -> Dict[Tuple[str, str, str], Tuple[int, bytes]]:
+	rows = {}
+	for i in range(0, len(keys), _SELECT_MANY_CHUNK):
+		chunk = keys[i:i + _SELECT_MANY_CHUNK]
+		sql = _SELECT_MANY_SQL.format(", ".join(["(?, ?, ?)"] * len(chunk)))
+		for name, rdclass, rdtype, ttl, wire in db.execute(sql, [param for key in chunk for param in key]):
+			rows[(name, rdclass, rdtype)] = (ttl, wire)
+	return rows
+
+_SELECT_WIRE_SQL = """
+	SELECT ttl, wire
+	FROM record WHERE name_wire=? AND rdclass=? AND rdtype=?
+"""
+
+# like query_db (plus the wildcard fallback), but keyed by the lowercased wire-format name
+def query_db_wire(db: sqlite3.Connection, name_wire: bytes, rdtype: dns.rdatatype.RdataType, rdclass: dns.rdataclass.RdataClass) -> Optional[Tuple[int, bytes]]:
+	key = (name_wire, dns.rdataclass.to_text(rdclass), dns.rdatatype.to_text(rdtype))
+	if cache_get(negative_cache, key):
+		return None
+	row = db.execute(_SELECT_WIRE_SQL, key).fetchone()
+	if row is None and name_wire != b"\x00":
+		# swap the first label for a *
+		row = db.execute(_SELECT_WIRE_SQL, (b"\x01*" + name_wire[name_wire[0] + 1:], *key[1:])).fetchone()
+	if row is None:
+		cache_put(negative_cache, NEGATIVE_CACHE_SIZE, key, True)
+	return row
+
+_REPLACE_SQL = """
+	REPLACE INTO record (name, ttl, rdclass, rdtype, wire, name_wire)
+	VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+def insert_db(db: sqlite3.Connection, row: RowType) -> None:
+	db.execute(_REPLACE_SQL, row)
+	db.commit()
+	negative_cache.clear()
+	rrset_cache.clear()
 
 def absolutify(name: str) -> str:
 	if name.endswith("."):
 		return name
 	return name + "."
 
-def answer_question(db: sqlite3.Connection, question: dns.rrset.RRset) -> dns.rrset.RRset:
-	name = question.name.to_text()
+def answer_question(db: sqlite3.Connection, question: dns.rrset.RRset) -> Optional[dns.rrset.RRset]:
+	name = question.name.to_text().lower()
 	rdclass = dns.rdataclass.to_text(question.rdclass)
 	rdtype = dns.rdatatype.to_text(question.rdtype)
-	rrset = query_db(db, name, rdclass, rdtype)
-	if rrset is not None:
-		return rrset
-	# try again looking for wildcards
-	_, _, suffix = name.partition(".")
-	rrset = query_db(db, "*." + suffix, rdclass, rdtype, override_name=name)
+	rrset = lookup_rrset(db, name, rdclass, rdtype)
 	if rrset is None:
-		raise KeyError()
+		# try again looking for wildcards
+		_, _, suffix = name.partition(".")
+		wildcard = lookup_rrset(db, "*." + suffix, rdclass, rdtype)
+		if wildcard is None:
+			return None
+		rrset = dns.rrset.from_rdata_list(name, wildcard.ttl, list(wildcard))
 	return rrset
 
+# like answer_question, but looking up all the questions (and their wildcards) in one go
+def answer_questions(db: sqlite3.Connection, questions: List[dns.rrset.RRset]) -> List[Optional[dns.rrset.RRset]]:
+	keys = []
+	for question in questions:
+		name = question.name.to_text().lower()
+		rdclass = dns.rdataclass.to_text(question.rdclass)
+		rdtype = dns.rdatatype.to_text(question.rdtype)
+		_, _, suffix = name.partition(".")
+		keys += [(name, rdclass, rdtype), ("*." + suffix, rdclass, rdtype)]
+	rows = query_db_many(db, keys)
+	answers: List[Optional[dns.rrset.RRset]] = []
+	for question, i in zip(questions, range(0, len(keys), 2)):
+		row = rows.get(keys[i]) or rows.get(keys[i + 1])
+		if row is None:
+			answers.append(None)
+			continue
+		ttl, wire = row
+		_, rdclass, rdtype = keys[i]
+		answers.append(dns.rrset.from_rdata_list(question.name, ttl, wire_to_rdatas(rdclass, rdtype, wire)))
+	return answers
+
 def handle_dns_query(db: sqlite3.Connection, query: dns.message.Message) -> dns.message.Message:
-	logger.info(f"Question: {query.question}")
-	response = dns.message.make_response(query)
+	logger.info("Question: %s", query.question)
+	response = dns.message.make_response(query, our_payload=EDNS_PAYLOAD)
 	try:
-		response.answer = [answer_question(db, q) for q in query.question]
-	except KeyError:
-		response.set_rcode(dns.rcode.NXDOMAIN)
+		if len(query.question) == 1: # i.e. basically always, and this way goes via the rrset cache
+			answers = [answer_question(db, query.question[0])]
+		else:
+			answers = answer_questions(db, query.question)
+		if None in answers:
+			response.set_rcode(dns.rcode.NXDOMAIN)
+		else:
+			response.answer = answers
 	except Exception as e:
 		logging.exception(e)
 		response.set_rcode(dns.rcode.SERVFAIL)
-	logger.info(f"Answer:   {response.answer}")
+	logger.info("Answer:   %s", response.answer)
 	return response
 
+def truncate(response_bytes: bytes, max_len: int) -> bytes:
+	# set the TC flag directly, rather than having dnspython serialise the whole response again
+	return response_bytes[:2] + bytes([response_bytes[2] | 0x02]) + response_bytes[3:max_len]
+
+def parse_simple_query(data: bytes) -> Optional[Tuple[WireCacheKey, int]]:
+	"""
+	Parse just enough of a query to key the wire cache, without going through
+	dnspython. Only plain queries (opcode QUERY, one question, and no other
+	records except an EDNS version 0 OPT) are handled, anything else returns
+	None. EDNS options are ignored, except for padding, which dnspython deals with.
+
+	Returns the cache key and the offset of the end of the question section.
+	"""
+	# header: id, flags, qdcount=1, ancount=0, nscount=0, arcount=0 or 1
+	if len(data) < 12 or data[2] & 0xf8 or data[4:10] != b"\x00\x01\x00\x00\x00\x00" or data[10:12] not in (b"\x00\x00", b"\x00\x01"):
+		return None
+	i = 12
+	while True: # skip over the qname labels
+		if i >= len(data) or data[i] & 0xc0: # no compression pointers in a question
+			return None
+		if data[i] == 0:
+			break
+		i += data[i] + 1
+	if i - 12 > 254:
+		return None
+	question_end = i + 5
+	edns = data[11] == 1
+	if edns and not is_simple_opt(data, question_end):
+		return None
+	if not edns and question_end != len(data):
+		return None
+	qtype, qclass = _QTYPE_QCLASS.unpack_from(data, i + 1)
+	return (data[12:i + 1].lower(), qtype, qclass, edns), question_end
+
+def is_simple_opt(data: bytes, i: int) -> bool:
+	# whether the rest of data, from i, is an OPT RR that we can answer with _OPT_RR
+	if i + _OPT_HEAD.size > len(data):
+		return False
+	name, rdtype, _, _, version, _, rdlen = _OPT_HEAD.unpack_from(data, i)
+	i += _OPT_HEAD.size
+	if name != 0 or rdtype != dns.rdatatype.OPT or version != 0 or i + rdlen != len(data):
+		return False
+	while i < len(data):
+		if i + _OPTION_HEAD.size > len(data):
+			return False
+		code, length = _OPTION_HEAD.unpack_from(data, i)
+		if code == dns.edns.OptionType.PADDING: # the response would need padding too
+			return False
+		i += _OPTION_HEAD.size + length
+	return i == len(data)
+
+# The next few functions write responses into a caller-provided scratch buffer,
+# rather than allocating new bytes for each one. The result is a memoryview into
+# buf, so it needs to be sent (or copied) before buf is reused.
+
+def fast_response(buf: bytearray, query: bytes, question_end: int, qtype: int, qclass: int, edns: bool, row: Optional[Tuple[int, bytes]], rcode: int=dns.rcode.NXDOMAIN) -> Optional[memoryview]:
+	"""
+	Build the response to a query that parse_simple_query accepted, from the
+	result of query_db_wire, without going through dnspython. If row is None,
+	the response has no answers and the given rcode. If edns is set, the
+	response ends with _OPT_RR.
+
+	Returns None if the response wouldn't fit in buf.
+	"""
+	txid, = _U16.unpack_from(query)
+	flags = 0x8000 | ((query[2] & 0x01) << 8) # QR, plus RD copied from the query
+	buf[12:question_end] = query[12:question_end]
+	end = len(buf) - len(_OPT_RR) if edns else len(buf) # leave room for the OPT
+	ancount = 0
+	n = question_end
+	if row is None:
+		flags |= rcode
+	else:
+		ttl, wire = row
+		wire_view = memoryview(wire)
+		i = 0
+		while i < len(wire): # each rdata is already prefixed with its RDLENGTH
+			rdlen, = _U16.unpack_from(wire, i)
+			rr_end = n + _RR_HEAD.size + 2 + rdlen
+			if rr_end > end:
+				return None
+			# the owner name is always a pointer to the qname, for wildcards too
+			_RR_HEAD.pack_into(buf, n, 0xc00c, qtype, qclass, ttl)
+			buf[n + _RR_HEAD.size:rr_end] = wire_view[i:i + 2 + rdlen]
+			ancount += 1
+			i += 2 + rdlen
+			n = rr_end
+	if edns:
+		buf[n:n + len(_OPT_RR)] = _OPT_RR
+		n += len(_OPT_RR)
+	_HDR.pack_into(buf, 0, txid, flags, 1, ancount, 0, int(edns))
+	return memoryview(buf)[:n]
+
+def cached_response(buf: bytearray, wire_cache: WireCache, data: bytes, parsed: Tuple[WireCacheKey, int]) -> Optional[memoryview]:
+	key, question_end = parsed
+	template = cache_get(wire_cache, key)
+	if template is None:
+		return None
+	# patch in the txid, RD flag, and question (which may differ in case)
+	buf[:len(template)] = template
+	buf[:2] = data[:2]
+	buf[2] |= data[2] & 0x01
+	buf[12:question_end] = data[12:question_end]
+	return memoryview(buf)[:len(template)]
+
+def cache_response(wire_cache: WireCache, key: WireCacheKey, ttl: int, response_bytes: Union[bytes, memoryview]) -> None:
+	# only UDP-sized responses, since the cache is shared between UDP and TCP
+	if ttl <= 0 or len(response_bytes) > 512:
+		return
+	# the template has the txid zeroed and RD cleared, to be patched per-query
+	template = b"\x00\x00" + bytes([response_bytes[2] & 0xfe]) + bytes(response_bytes[3:])
+	# no longer than the other caches, which go stale at the same time
+	cache_put(wire_cache, WIRE_CACHE_SIZE, key, template, min(ttl, CACHE_TTL))
+
+async def answer_query(db: sqlite3.Connection, wire_cache: WireCache, buf: bytearray, data: bytes, parsed: Optional[Tuple[WireCacheKey, int]], max_len: int, proto: str, host: str) -> Optional[Union[bytes, memoryview]]:
+	"""
+	Answer a query that wasn't in the wire cache, via the fast path if it's
+	simple enough (and the response fits in buf), otherwise via dnspython.
+
+	Returns the response (truncated to max_len if needed), or None if the
+	query was malformed.
+	"""
+	if parsed is not None:
+		(name_wire, qtype, qclass, edns), question_end = parsed
+		rdtype = dns.rdatatype.RdataType.make(qtype)
+		rdclass = dns.rdataclass.RdataClass.make(qclass)
+		if not dns.rdatatype.is_metatype(rdtype) and not dns.rdataclass.is_metaclass(rdclass):
+			logger.info("Received DNS query from %s %s (fast)", proto, host)
+			try:
+				row = await run_db(query_db_wire, db, name_wire, rdtype, rdclass)
+			except Exception as e: # e.g. the db is locked
+				logging.exception(e)
+				return fast_response(buf, data, question_end, qtype, qclass, edns, None, dns.rcode.SERVFAIL)
+			fast = fast_response(buf, data, question_end, qtype, qclass, edns, row)
+			if fast is not None:
+				if row is not None:
+					cache_response(wire_cache, parsed[0], row[0], fast)
+				return fast
+			# otherwise, let dnspython deal with truncation
+
+	try:
+		query = dns.message.from_wire(data)
+	except dns.exception.DNSException as e:
+		logger.warning("Malformed DNS query from %s %s: %s", proto, host, e)
+		return None
+	logger.info("Received DNS query from %s %s", proto, host)
+	response = await run_db(handle_dns_query, db, query)
+	response_bytes = response.to_wire()
+	if len(response_bytes) > max_len:
+		response_bytes = truncate(response_bytes, max_len) # for UDP, the client should retry on TCP
+	elif parsed is not None and response.rcode() == dns.rcode.NOERROR and response.answer:
+		cache_response(wire_cache, parsed[0], min(rrset.ttl for rrset in response.answer), response_bytes)
+	return response_bytes
+
 class DNSProtocolUDP(asyncio.DatagramProtocol):
-	def __init__(self, db: sqlite3.Connection) -> None:
+	__slots__ = ("db", "wire_cache", "tasks", "buf", "transport")
+
+	def __init__(self, db: sqlite3.Connection, wire_cache: WireCache) -> None:
 		self.db = db
+		self.wire_cache = wire_cache
+		self.tasks: Set[asyncio.Task[None]] = set() # strong refs to in-flight queries
+		# sendto() copies anything it can't send immediately, so one buffer can be
+		# reused for every response
+		self.buf = bytearray(512)
 		super().__init__()
 
-	def connection_made(self, transport: asyncio.DatagramTransport) -> None:
-		self.transport = transport
+	def connection_made(self, transport: asyncio.BaseTransport) -> None:
+		self.transport = cast(asyncio.DatagramTransport, transport)
 
 	def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
-		query = dns.message.from_wire(data)
-		logger.info(f"Received DNS query from UDP {addr[0]}")
-		response = handle_dns_query(self.db, query)
-		response_bytes = response.to_wire()
-		if len(response_bytes) > 512:
-			response.flags |= dns.flags.TC # truncated response (client should retry on TCP)
-			response_bytes = response.to_wire()[:512]
-		self.transport.sendto(response_bytes, addr)
+		parsed = parse_simple_query(data)
+		if parsed is not None:
+			response_bytes = cached_response(self.buf, self.wire_cache, data, parsed)
+			if response_bytes is not None:
+				logger.info("Received DNS query from UDP %s (cached)", addr[0])
+				self.transport.sendto(response_bytes, addr)
+				return
+
+		# don't hold up receiving further packets while we wait on the db
+		task = asyncio.create_task(self.handle_query(data, addr, parsed))
+		self.tasks.add(task)
+		task.add_done_callback(self.tasks.discard)
+
+	async def handle_query(self, data: bytes, addr: Tuple[str, int], parsed: Optional[Tuple[WireCacheKey, int]]) -> None:
+		response_bytes = await answer_query(self.db, self.wire_cache, self.buf, data, parsed, 512, "UDP", addr[0])
+		if response_bytes is not None:
+			self.transport.sendto(response_bytes, addr)
 
+def make_udp_socket(host: str, port: int) -> socket.socket:
+	family, type_, proto, _, sockaddr = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+	sock = socket.socket(family, type_, proto)
+	# give the kernel plenty of space to queue up packets that arrive while
+	# we're busy, rather than dropping them
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF_SIZE)
+	sock.bind(sockaddr)
+	return sock
 
-async def handle_tcp_client(db: sqlite3.Connection, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+async def handle_tcp_client(db: sqlite3.Connection, wire_cache: WireCache, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+	host = writer.get_extra_info("peername")[0]
+	buf = bytearray(4096) # larger responses go via dnspython
 	try:
 		while True:
-			data_len = int.from_bytes(await reader.readexactly(2))
+			data_len, = _U16.unpack(await reader.readexactly(2))
 			data = await reader.readexactly(data_len)
-			query = dns.message.from_wire(data)
-			logger.info(f"Received DNS query from TCP {writer.get_extra_info('peername')[0]}")
-			response = handle_dns_query(db, query)
-			response_bytes = response.to_wire()
-			if len(response_bytes) > 0xffff: # is this the right thing to do?
-				response.flags |= dns.flags.TC
-				response_bytes = response.to_wire()[:0xffff]
-			writer.write(len(response_bytes).to_bytes(2) + response_bytes)
+			parsed = parse_simple_query(data)
+			response_bytes: Optional[Union[bytes, memoryview]] = None
+			if parsed is not None:
+				response_bytes = cached_response(buf, wire_cache, data, parsed)
+				if response_bytes is not None:
+					logger.info("Received DNS query from TCP %s (cached)", host)
+			if response_bytes is None:
+				response_bytes = await answer_query(db, wire_cache, buf, data, parsed, 0xffff, "TCP", host) # is 0xffff the right thing to do?
+				if response_bytes is None:
+					break
+			# unlike sendto(), the transport may hang on to what we pass it, so it can't be a view of buf
+			writer.writelines((_U16.pack(len(response_bytes)), bytes(response_bytes)))
 			await writer.drain()
 	except asyncio.IncompleteReadError:
 		pass
@@ -127,29 +482,24 @@ routes = web.RouteTableDef()
 @routes.put("/{name}/{rdtype}/{rdata}") # example.com/A/1.2.3.4
 @routes.put("/{name}/{ttl}/{rdtype}/{rdata}") # example.com/60/A/1.2.3.4
 @routes.put("/{name}/{ttl}/{rdclass}/{rdtype}/{rdata}") # example.com/60/IN/A/1.2.3.4
-async def put_record(request: web.Request):
+async def put_record(request: web.Request) -> web.StreamResponse:
 	parts = request.match_info
 	try:
 		rrset = dns.rrset.from_text(
 			absolutify(parts["name"]),
-			parts.get("ttl", DEFAULT_TTL),
+			dns.ttl.make(parts.get("ttl", DEFAULT_TTL)),
 			parts.get("rdclass", "IN"),
 			parts.get("rdtype", "A"),
 			*parts["rdata"].split(RDATA_SEP)
 		)
-	except dns.exception.SyntaxError as e:
+		rrset.name = rrset.name.canonicalize() # i.e. lowercased, so lookups needn't worry about case
+		if rrset.rdtype == dns.rdatatype.ANY:
+			return web.HTTPBadRequest(text=f"can't set ANY\n")
+		row = rrset_to_row(rrset)
+	except dns.exception.DNSException as e:
 		return web.HTTPBadRequest(text=f"{e}\n")
-	if rrset.rdtype == dns.rdatatype.ANY:
-		return web.HTTPBadRequest(text=f"can't set ANY\n")
-	db: sqlite3.Connection = request.app["db"]
-	db.execute(
-		"""
-			REPLACE INTO record (name, ttl, rdclass, rdtype, rdatas)
-			VALUES (?, ?, ?, ?, ?)
-		""",
-		rrset_to_row(rrset)
-	)
-	db.commit()
+	await run_db(insert_db, request.app["db"], row)
+	request.app["wire_cache"].clear() # a wildcard could affect any cached name, so start over
 	return web.Response()
 
 
@@ -160,56 +510,111 @@ async def put_record(request: web.Request):
 @routes.get("/{name}/{rdtype}/")
 @routes.get("/{name}/{rdclass}/{rdtype}")
 @routes.get("/{name}/{rdclass}/{rdtype}/")
-async def get_record(request: web.Request):
+async def get_record(request: web.Request) -> web.StreamResponse:
 	parts = request.match_info
 	db: sqlite3.Connection = request.app["db"]
-	rrset = query_db(db,
-		absolutify(parts["name"]),
-		parts.get("rdclass", "IN"),
-		parts.get("rdtype", "A")
-	)
+	name = absolutify(parts["name"]).lower()
+	rdclass = parts.get("rdclass", "IN").upper()
+	rdtype = parts.get("rdtype", "A").upper()
+	rrset = await run_db(lookup_rrset, db, name, rdclass, rdtype)
 	if rrset is None:
 		return web.HTTPNotFound(text="NXDOMAIN\n")
 	return web.Response(text=f"{rrset}\n")
 
 
 @routes.get("/")
-async def dump_records(request: web.Request):
+async def dump_records(request: web.Request) -> web.StreamResponse:
 	db: sqlite3.Connection = request.app["db"]
 	res = web.StreamResponse()
 	res.content_type = "text/plain"
 	await res.prepare(request)
-	for row in db.execute("SELECT name, ttl, rdclass, rdtype, rdatas FROM record"):
-		await res.write(str(row_to_rrset(row)).encode() + b"\n")
+	cursor = await run_db(db.execute, "SELECT name, ttl, rdclass, rdtype, wire FROM record")
+	while rows := await run_db(cursor.fetchmany, 1000):
+		# equivalent to str()-ing each record as an RRset, without the RRset
+		await res.write("".join(
+			f"{name} {ttl} {rdclass} {rdtype} {rdata}\n"
+			for name, ttl, rdclass, rdtype, wire in rows
+			for rdata in wire_to_rdatas(rdclass, rdtype, wire)
+		).encode())
 	await res.write_eof()
 	return res
 
 
-async def async_main(db_path: str, listen_host: str, dns_port: int, http_port: int):
-	loop = asyncio.get_running_loop()
-	logging.basicConfig(level=logging.INFO)
+# every schema before this one kept each record's rdatas as RDATA_SEP-separated text,
+# which is enough to rebuild the current row from scratch. Older versions accepted
+# relative names in rdatas (e.g. PUT /c.test/CNAME/target), which could never be
+# served, so they're taken to be relative to the root.
+def migrate_rows(db: sqlite3.Connection, db_path: str) -> List[RowType]:
+	rows = []
+	for name, ttl, rdclass, rdtype, rdatas in db.execute("SELECT name, ttl, rdclass, rdtype, rdatas FROM record"):
+		try:
+			rrset = dns.rrset.from_rdata_list(name, ttl, [
+				dns.rdata.from_text(rdclass, rdtype, rdata, origin=dns.name.root, relativize=False)
+				for rdata in rdatas.split(RDATA_SEP)
+			])
+			rrset.name = rrset.name.canonicalize()
+			rows.append(rrset_to_row(rrset))
+		except dns.exception.DNSException as e:
+			logger.warning(f"Dropping record {name} {rdclass} {rdtype} {rdatas!r} from {db_path!r}, it can't be migrated: {e}")
+	return rows
 
-	# set up the db
-	logger.info(f"Persisting records to {db_path!r}")
-	db = sqlite3.connect(db_path)
+def open_db(db_path: str) -> sqlite3.Connection:
+	# a single connection is shared by everything, but it's only ever used from db_executor after setup
+	db = sqlite3.connect(db_path, check_same_thread=False)
+	db.execute("PRAGMA journal_mode=WAL") # no-op for :memory:
+	db.execute("PRAGMA synchronous=NORMAL") # safe in WAL mode, and avoids an fsync per commit
+	db.execute("PRAGMA cache_size=-64000") # 64MB
+	db.execute("PRAGMA mmap_size=268435456") # 256MB
+	db.execute("PRAGMA temp_store=MEMORY")
+	db.execute("PRAGMA busy_timeout=5000") # in case something else has the db open
+	version = db.execute("PRAGMA user_version").fetchone()[0]
+	has_records = db.execute("SELECT 1 FROM sqlite_master WHERE name='record'").fetchone() is not None
+	if has_records and version > SCHEMA_VERSION:
+		raise SystemExit(f"{db_path!r} was created by a newer version of ihatedns")
+	migrated_rows = None
+	if has_records and version < SCHEMA_VERSION:
+		logger.info(f"Migrating {db_path!r} from schema version {version} to {SCHEMA_VERSION}")
+		migrated_rows = migrate_rows(db, db_path)
+
+	db.execute("BEGIN") # so that a migration either happens completely or not at all
+	if migrated_rows is not None:
+		db.execute("DROP TABLE record")
 	db.execute("""CREATE TABLE IF NOT EXISTS record (
 		name TEXT,
 		ttl INTEGER,
 		rdclass TEXT,
 		rdtype TEXT,
-		rdatas TEXT,
+		wire BLOB,
+		name_wire BLOB,
 		PRIMARY KEY(name, rdclass, rdtype)
 	)""")
+	db.execute("CREATE INDEX IF NOT EXISTS record_name_wire ON record(name_wire, rdclass, rdtype)")
+	if migrated_rows is not None:
+		db.executemany(_REPLACE_SQL, migrated_rows)
+	db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+	db.commit()
+	return db
+
+async def async_main(db_path: str, listen_host: str, dns_port: int, http_port: int) -> None:
+	loop = asyncio.get_running_loop()
+	logging.basicConfig(level=logging.INFO)
+
+	# set up the db
+	logger.info(f"Persisting records to {db_path!r}")
+	db = open_db(db_path)
+
+	# cache of serialised UDP responses, invalidated whenever records change
+	wire_cache: WireCache = {}
 
 	# start the UDP DNS server
 	transport, _ = await loop.create_datagram_endpoint(
-		lambda: DNSProtocolUDP(db), (listen_host, dns_port)
+		lambda: DNSProtocolUDP(db, wire_cache), sock=make_udp_socket(listen_host, dns_port)
 	)
 	logger.info(f"DNS server listening on UDP {listen_host}:{dns_port}")
 
 	# start the TCP DNS server
 	await asyncio.start_server(
-		lambda r, w: handle_tcp_client(db, r, w), # inject the db
+		lambda r, w: handle_tcp_client(db, wire_cache, r, w), # inject the db and cache
 		host=listen_host,
 		port=dns_port
 	)
@@ -218,6 +623,7 @@ async def async_main(db_path: str, listen_host: str, dns_port: int, http_port: i
 	# set up the HTTP server
 	app = web.Application()
 	app["db"] = db
+	app["wire_cache"] = wire_cache
 	app.add_routes(routes)
 	runner = web.AppRunner(app)
 	await runner.setup()
@@ -233,7 +639,7 @@ async def async_main(db_path: str, listen_host: str, dns_port: int, http_port: i
 	finally:
 		transport.close() # close the DNS server
 
-def main():
+def main() -> None:
 	parser = argparse.ArgumentParser(
 		description="The DNS server for people who hate DNS"
 	)